@@ -1,45 +1,109 @@
-from flask import Flask, render_template, request, redirect, url_for, flash, jsonify
+import os
+import csv
+import click
+from flask import Flask, render_template, request, redirect, url_for, flash, jsonify, g, has_app_context
 from flask_login import LoginManager, login_user, logout_user, login_required, current_user
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import contains_eager, joinedload
 from datetime import datetime
-from models import db, User, Donation, Request, Task, ActivityLog, get_platform_stats
+from jinja2 import FileSystemBytecodeCache
+from models import (db, cache, User, Donation, Request, Task, ActivityLog, upgrade_schema, init_platform_stats,
+                    bump_platform_stats, get_platform_stats, get_recent_donations, get_leaderboard,
+                    get_completed_deliveries, bulk_insert_donations, DELIVERIES_PAGE_SIZE)
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = 'social-mentor-secret-key-2024'
 app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///social_mentor.db'
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+# Sized for many gevent greenlets per worker
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+    'pool_size': 20,
+    'max_overflow': 40,
+    'pool_pre_ping': True,
+    'pool_recycle': 1800
+}
+if app.config['SQLALCHEMY_DATABASE_URI'].startswith('sqlite'):
+    # Lets greenlets share pooled SQLite connections; other drivers reject this argument
+    app.config['SQLALCHEMY_ENGINE_OPTIONS']['connect_args'] = {'check_same_thread': False}
+# Stored on disk so every gunicorn worker on the host sees the same entries and invalidations
+app.config['CACHE_TYPE'] = 'FileSystemCache'
+app.config['CACHE_DIR'] = os.path.join(app.instance_path, 'cache')
+app.config['CACHE_DEFAULT_TIMEOUT'] = 60
+app.config['QUERY_COUNT_THRESHOLD'] = 15  # warn in debug when a request runs more queries
+
+# Compiled templates are shared across processes through a per-user temp directory
+app.jinja_env.bytecode_cache = FileSystemBytecodeCache()
 
 db.init_app(app)
+cache.init_app(app)
 login_manager = LoginManager()
 login_manager.init_app(app)
 login_manager.login_view = 'login'
 
 @login_manager.user_loader
 def load_user(user_id):
-    return User.query.get(int(user_id))
+    return db.session.get(User, int(user_id))
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def count_query(conn, cursor, statement, parameters, context, executemany):
+    if has_app_context():
+        g.query_count = g.get('query_count', 0) + 1
+
+@app.after_request
+def log_query_count(response):
+    # Catch N+1 regressions: every route reports how many queries it ran
+    query_count = g.get('query_count', 0)
+    app.logger.debug('%s ran %d queries', request.endpoint, query_count)
+    if app.debug and query_count > app.config['QUERY_COUNT_THRESHOLD']:
+        app.logger.warning('%s ran %d queries (threshold %d), check for N+1 loading',
+                           request.endpoint, query_count, app.config['QUERY_COUNT_THRESHOLD'])
+    return response
 
 # Create tables
 with app.app_context():
     db.create_all()
+    upgrade_schema()
+    init_platform_stats()
+
+# Compile every template up front so workers forked from a preloaded master start hot
+for template_name in app.jinja_env.list_templates():
+    app.jinja_env.get_template(template_name)
 
 # ==================== PUBLIC ROUTES ====================
 
 @app.route('/')
 def index():
+    # The page itself is per-user (nav, flashes), so only its data is cached
     stats = get_platform_stats()
-    recent_donations = Donation.query.order_by(Donation.created_at.desc()).limit(5).all()
+    recent_donations = get_recent_donations()
     return render_template('index.html', stats=stats, recent_donations=recent_donations)
 
+def delivery_cursor():
+    """The (delivered_at, id) keyset cursor from the query string; unparseable values are ignored"""
+    return (request.args.get('before', type=datetime.fromisoformat),
+            request.args.get('before_id', type=int))
+
+def next_delivery_cursor(deliveries, limit):
+    """Query args for the page after deliveries, or None when this is the last page"""
+    if len(deliveries) < limit:
+        return None
+    last = deliveries[-1]
+    return {'before': last.delivered_at.isoformat(), 'before_id': last.id}
+
 @app.route('/impact')
 def impact():
     stats = get_platform_stats()
-    # Get recent completed tasks with details
-    completed_tasks = Task.query.filter_by(status='delivered').order_by(Task.delivered_at.desc()).limit(20).all()
-    # Get top volunteers
-    top_volunteers = User.query.filter_by(role='volunteer').order_by(User.points.desc()).limit(10).all()
-    # Get top donors
-    top_donors = User.query.filter_by(role='donor').order_by(User.points.desc()).limit(10).all()
+    # Get recent completed tasks with details, paged by (?before=<iso timestamp>&before_id=<task id>)
+    completed_tasks = get_completed_deliveries(DELIVERIES_PAGE_SIZE, *delivery_cursor())
+    next_before = next_delivery_cursor(completed_tasks, DELIVERIES_PAGE_SIZE)
+    # Top volunteers and donors come from the cached leaderboard
+    leaders = get_leaderboard()
+    top_volunteers = leaders['volunteers'][:10]
+    top_donors = leaders['donors'][:10]
     return render_template('impact.html', stats=stats, completed_tasks=completed_tasks, 
-                          top_volunteers=top_volunteers, top_donors=top_donors)
+                          top_volunteers=top_volunteers, top_donors=top_donors,
+                          next_before=next_before)
 
 # ==================== AUTH ROUTES ====================
 
@@ -63,7 +127,9 @@ def register():
         user = User(name=name, email=email, role=role, location=location, phone=phone)
         user.set_password(password)
         db.session.add(user)
+        bump_platform_stats(total_users=1, total_volunteers=1 if role == 'volunteer' else 0)
         db.session.commit()
+        cache.delete_memoized(get_platform_stats)
         
         flash('Registration successful! Please login.', 'success')
         return redirect(url_for('login'))
@@ -78,7 +144,7 @@ def login():
     if request.method == 'POST':
         email = request.form.get('email')
         password = request.form.get('password')
-        user = User.query.filter_by(email=email).first()
+        user = User.query.options(db.undefer(User.password_hash)).filter_by(email=email).first()
         
         if user and user.check_password(password):
             login_user(user)
@@ -115,15 +181,15 @@ def donor_dashboard():
         flash('Access denied', 'error')
         return redirect(url_for('dashboard'))
     
-    my_donations = Donation.query.filter_by(donor_id=current_user.id).order_by(Donation.created_at.desc()).all()
-    active_donations = [d for d in my_donations if d.status != 'completed']
-    completed_donations = [d for d in my_donations if d.status == 'completed']
+    my_donations = Donation.query.filter_by(donor_id=current_user.id).order_by(Donation.created_at.desc())
+    active_donations = my_donations.filter(Donation.status != 'completed').all()
+    completed_donations = my_donations.filter(Donation.status == 'completed').all()
     
     # Calculate impact
     total_items = sum(d.quantity for d in completed_donations)
     
     return render_template('donor/dashboard.html', 
-                          donations=my_donations,
+                          donations=active_donations + completed_donations,
                           active_donations=active_donations,
                           completed_donations=completed_donations,
                           total_items=total_items)
@@ -152,19 +218,22 @@ def create_donation():
         
         db.session.add(donation)
         
-        # Create a task for this donation
-        task = Task(donation_id=donation.id)
+        # Create a task for this donation; foreign keys are resolved on flush
+        task = Task(donation=donation)
         db.session.add(task)
         
+        # Log activity
+        log = ActivityLog(task=task, action=f'Donation created by {current_user.name}', actor_id=current_user.id)
+        db.session.add(log)
+        
         # Add points to donor
         current_user.add_points(10)
+        bump_platform_stats(total_donations=1)
         
         db.session.commit()
-        
-        # Log activity
-        log = ActivityLog(task_id=task.id, action=f'Donation created by {current_user.name}', actor_id=current_user.id)
-        db.session.add(log)
-        db.session.commit()
+        cache.delete_memoized(get_platform_stats)
+        cache.delete_memoized(get_recent_donations)
+        cache.delete_memoized(get_leaderboard)
         
         flash('Donation created successfully! +10 points', 'success')
         return redirect(url_for('donor_dashboard'))
@@ -180,28 +249,36 @@ def volunteer_dashboard():
         flash('Access denied', 'error')
         return redirect(url_for('dashboard'))
     
+    # Donation rows come from the join itself; only the donor needs an extra join
+    open_tasks = Task.query.join(Task.donation).options(
+        contains_eager(Task.donation).joinedload(Donation.donor)
+    )
+    
     # Get nearby tasks (same location)
-    nearby_tasks = Task.query.join(Donation).filter(
+    nearby_tasks = open_tasks.filter(
         Task.status == 'created',
         Task.volunteer_id == None,
         Donation.location == current_user.location
     ).all()
     
     # Also get tasks from other locations
-    other_tasks = Task.query.join(Donation).filter(
+    other_tasks = open_tasks.filter(
         Task.status == 'created',
         Task.volunteer_id == None,
         Donation.location != current_user.location
     ).limit(10).all()
     
     # My active tasks
-    my_tasks = Task.query.filter(
+    my_tasks = Task.query.options(
+        joinedload(Task.donation).joinedload(Donation.donor),
+        joinedload(Task.request)
+    ).filter(
         Task.volunteer_id == current_user.id,
         Task.status.in_(['assigned', 'picked_up'])
     ).all()
     
     # Completed tasks
-    completed_tasks = Task.query.filter(
+    completed_tasks = Task.query.options(joinedload(Task.donation)).filter(
         Task.volunteer_id == current_user.id,
         Task.status == 'delivered'
     ).order_by(Task.delivered_at.desc()).limit(10).all()
@@ -233,7 +310,7 @@ def accept_task(task_id):
     task.donation.status = 'matched'
     
     # Log activity
-    log = ActivityLog(task_id=task.id, action=f'Task accepted by volunteer {current_user.name}', actor_id=current_user.id)
+    log = ActivityLog(task=task, action=f'Task accepted by volunteer {current_user.name}', actor_id=current_user.id)
     db.session.add(log)
     
     db.session.commit()
@@ -247,39 +324,70 @@ def update_task(task_id, status):
         flash('Access denied', 'error')
         return redirect(url_for('dashboard'))
     
-    task = Task.query.get_or_404(task_id)
+    # Each status may only be reached from the ones before it, so repeats and backward moves are rejected
+    if status == 'picked_up':
+        values = {'status': 'picked_up', 'picked_up_at': datetime.utcnow()}
+        from_statuses = ['assigned']
+    elif status == 'delivered':
+        values = {'status': 'delivered', 'delivered_at': datetime.utcnow()}
+        from_statuses = ['assigned', 'picked_up']
+    else:
+        flash('Invalid status', 'error')
+        return redirect(url_for('volunteer_dashboard'))
     
-    if task.volunteer_id != current_user.id:
-        flash('Not your task', 'error')
+    # Update in place; ownership and transition checks are part of the WHERE clause, so no rows are loaded
+    no_sync = {'synchronize_session': False}
+    result = db.session.execute(
+        db.update(Task).where(
+            Task.id == task_id,
+            Task.volunteer_id == current_user.id,
+            Task.status.in_(from_statuses)
+        ).values(**values),
+        execution_options=no_sync
+    )
+    if result.rowcount == 0:
+        task = db.get_or_404(Task, task_id)
+        if task.volunteer_id != current_user.id:
+            flash('Not your task', 'error')
+        else:
+            flash(f'Task is already {task.status.replace("_", " ")}', 'error')
         return redirect(url_for('volunteer_dashboard'))
     
     if status == 'picked_up':
-        task.status = 'picked_up'
-        task.picked_up_at = datetime.utcnow()
         log_action = f'Items picked up by {current_user.name}'
-    elif status == 'delivered':
-        task.status = 'delivered'
-        task.delivered_at = datetime.utcnow()
-        task.donation.status = 'completed'
+    else:
+        donation_id = db.select(Task.donation_id).where(Task.id == task_id).scalar_subquery()
+        request_id = db.select(Task.request_id).where(Task.id == task_id).scalar_subquery()
+        db.session.execute(
+            db.update(Donation).where(Donation.id == donation_id).values(status='completed'),
+            execution_options=no_sync
+        )
         
         # Award points
         current_user.add_points(15)
+        current_user.delivered_count += 1
+        bump_platform_stats(
+            completed_deliveries=1,
+            items_donated=db.select(Donation.quantity).where(Donation.id == donation_id).scalar_subquery()
+        )
         
         # If there's a matched request, update it too
-        if task.request_id:
-            task.request.status = 'fulfilled'
+        db.session.execute(
+            db.update(Request).where(Request.id == request_id).values(status='fulfilled'),
+            execution_options=no_sync
+        )
         
         log_action = f'Items delivered by {current_user.name}'
         flash('Delivery completed! +15 points', 'success')
-    else:
-        flash('Invalid status', 'error')
-        return redirect(url_for('volunteer_dashboard'))
     
     # Log activity
-    log = ActivityLog(task_id=task.id, action=log_action, actor_id=current_user.id)
+    log = ActivityLog(task_id=task_id, action=log_action, actor_id=current_user.id)
     db.session.add(log)
     
     db.session.commit()
+    if status == 'delivered':
+        cache.delete_memoized(get_platform_stats)
+        cache.delete_memoized(get_leaderboard)
     return redirect(url_for('volunteer_dashboard'))
 
 @app.route('/volunteer/task/<int:task_id>')
@@ -308,7 +416,7 @@ def receiver_dashboard():
     fulfilled_requests = [r for r in my_requests if r.status == 'fulfilled']
     
     # Available donations in my area
-    available_donations = Donation.query.filter(
+    available_donations = Donation.query.options(joinedload(Donation.donor)).filter(
         Donation.status == 'available',
         Donation.location == current_user.location
     ).order_by(Donation.created_at.desc()).limit(10).all()
@@ -353,43 +461,38 @@ def smart_match():
     """Smart matching page - shows best matches based on location and category"""
     
     if current_user.role == 'receiver':
-        # Find available donations matching receiver's pending requests
-        my_requests = Request.query.filter_by(receiver_id=current_user.id, status='pending').all()
-        matches = []
+        # Find available donations (same location and item type) for all pending requests at once
+        rows = db.session.query(Request, Donation).join(Donation, db.and_(
+            Donation.status == 'available',
+            Donation.location == Request.location,
+            Donation.item_type == Request.item_type
+        )).options(joinedload(Donation.donor)).filter(
+            Request.receiver_id == current_user.id,
+            Request.status == 'pending'
+        ).order_by(Request.id, Donation.id).all()
         
-        for req in my_requests:
-            # Find donations in same location with same item type
-            matching_donations = Donation.query.filter(
-                Donation.status == 'available',
-                Donation.location == req.location,
-                Donation.item_type == req.item_type
-            ).all()
-            
-            if matching_donations:
-                matches.append({
-                    'request': req,
-                    'donations': matching_donations
-                })
+        grouped = {}
+        for req, donation in rows:
+            grouped.setdefault(req, []).append(donation)
+        matches = [{'request': req, 'donations': donations} for req, donations in grouped.items()]
         
         return render_template('match.html', matches=matches, role='receiver')
     
     elif current_user.role == 'donor':
-        # Find requests matching donor's donations
-        my_donations = Donation.query.filter_by(donor_id=current_user.id, status='available').all()
-        matches = []
+        # Find pending requests matching all of the donor's available donations at once
+        rows = db.session.query(Donation, Request).join(Request, db.and_(
+            Request.status == 'pending',
+            Request.location == Donation.location,
+            Request.item_type == Donation.item_type
+        )).options(joinedload(Request.receiver)).filter(
+            Donation.donor_id == current_user.id,
+            Donation.status == 'available'
+        ).order_by(Donation.id, Request.id).all()
         
-        for donation in my_donations:
-            matching_requests = Request.query.filter(
-                Request.status == 'pending',
-                Request.location == donation.location,
-                Request.item_type == donation.item_type
-            ).all()
-            
-            if matching_requests:
-                matches.append({
-                    'donation': donation,
-                    'requests': matching_requests
-                })
+        grouped = {}
+        for donation, req in rows:
+            grouped.setdefault(donation, []).append(req)
+        matches = [{'donation': donation, 'requests': requests} for donation, requests in grouped.items()]
         
         return render_template('match.html', matches=matches, role='donor')
     
@@ -407,7 +510,7 @@ def connect_match(donation_id, request_id):
     # Find existing task for this donation or create new one
     task = Task.query.filter_by(donation_id=donation_id).first()
     if not task:
-        task = Task(donation_id=donation_id)
+        task = Task(donation=donation)
         db.session.add(task)
     
     task.request_id = request_id
@@ -415,7 +518,7 @@ def connect_match(donation_id, request_id):
     req.status = 'matched'
     
     # Log activity
-    log = ActivityLog(task_id=task.id, 
+    log = ActivityLog(task=task, 
                      action=f'Donation matched with request by {current_user.name}', 
                      actor_id=current_user.id)
     db.session.add(log)
@@ -428,9 +531,8 @@ def connect_match(donation_id, request_id):
 
 @app.route('/leaderboard')
 def leaderboard():
-    volunteers = User.query.filter_by(role='volunteer').order_by(User.points.desc()).limit(20).all()
-    donors = User.query.filter_by(role='donor').order_by(User.points.desc()).limit(20).all()
-    return render_template('leaderboard.html', volunteers=volunteers, donors=donors)
+    leaders = get_leaderboard()
+    return render_template('leaderboard.html', volunteers=leaders['volunteers'], donors=leaders['donors'])
 
 # ==================== CERTIFICATE ====================
 
@@ -439,11 +541,73 @@ def leaderboard():
 def certificate():
     completed_count = 0
     if current_user.role == 'volunteer':
-        completed_count = Task.query.filter_by(volunteer_id=current_user.id, status='delivered').count()
+        completed_count = current_user.delivered_count
     elif current_user.role == 'donor':
         completed_count = Donation.query.filter_by(donor_id=current_user.id, status='completed').count()
     
     return render_template('certificate.html', user=current_user, completed_count=completed_count)
 
+# ==================== API ROUTES ====================
+
+@app.route('/api/impact.json')
+def api_impact():
+    rows = get_completed_deliveries(DELIVERIES_PAGE_SIZE, *delivery_cursor())
+    deliveries = [dict(row._asdict(), delivered_at=row.delivered_at.isoformat() if row.delivered_at else None)
+                  for row in rows]
+    leaders = get_leaderboard()
+    return jsonify({
+        'stats': get_platform_stats(),
+        'completed_deliveries': deliveries,
+        'next_before': next_delivery_cursor(rows, DELIVERIES_PAGE_SIZE),
+        'top_volunteers': [{'name': u['name'], 'points': u['points']} for u in leaders['volunteers'][:10]],
+        'top_donors': [{'name': u['name'], 'points': u['points']} for u in leaders['donors'][:10]]
+    })
+
+@app.route('/api/leaderboard.json')
+def api_leaderboard():
+    leaders = get_leaderboard()
+    return jsonify({
+        role: [{key: u[key] for key in ('name', 'location', 'points', 'badges')} for u in users]
+        for role, users in leaders.items()
+    })
+
+# ==================== CLI ====================
+
+@app.cli.command('import-donations')
+@click.argument('csv_file', type=click.File())
+def import_donations(csv_file):
+    """Bulk-import donations from a CSV whose headers are Donation columns (donor_id, item_type, ...)"""
+    required = {'donor_id', 'item_type', 'quantity', 'location'}
+    allowed = set(Donation.__table__.columns.keys()) - {'id', 'status', 'created_at'}
+    reader = csv.DictReader(csv_file)
+    unknown = set(reader.fieldnames or []) - allowed
+    if unknown:
+        raise click.BadParameter(f'unknown columns: {", ".join(sorted(unknown))}', param_hint='csv_file')
+    
+    rows = []
+    for line, row in enumerate(reader, start=2):
+        row = {key: value for key, value in row.items() if value}
+        missing = required - row.keys()
+        if missing:
+            raise click.ClickException(f'Row {line}: missing {", ".join(sorted(missing))}')
+        try:
+            row['donor_id'] = int(row['donor_id'])
+            row['quantity'] = int(row['quantity'])
+            if 'expiry_date' in row:
+                row['expiry_date'] = datetime.strptime(row['expiry_date'], '%Y-%m-%d').date()
+        except ValueError as e:
+            raise click.ClickException(f'Row {line}: {e}')
+        rows.append(row)
+    
+    known_donors = set(db.session.scalars(
+        db.select(User.id).where(User.id.in_({row['donor_id'] for row in rows}))
+    ))
+    for line, row in enumerate(rows, start=2):
+        if row['donor_id'] not in known_donors:
+            raise click.ClickException(f'Row {line}: no user with donor_id {row["donor_id"]}')
+    
+    donation_ids = bulk_insert_donations(rows)
+    click.echo(f'Imported {len(donation_ids)} donations')
+
 if __name__ == '__main__':
     app.run(debug=True)
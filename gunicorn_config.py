@@ -0,0 +1,23 @@
+import multiprocessing
+
+# NGINX (nginx.conf) proxies to this socket and serves static files itself
+bind = 'unix:/run/techmentorx/gunicorn.sock'
+
+# Every route is IO-bound (database + template rendering), so cooperative
+# gevent workers serve many requests per process instead of one.
+# Note: sqlite3 does blocking file IO in C that gevent cannot patch; a slow
+# query still stalls the whole worker. Use Postgres for real concurrency.
+worker_class = 'gevent'
+workers = multiprocessing.cpu_count() * 2 + 1
+worker_connections = 1000
+
+# Import the app (and compile its templates) once in the master; workers share it copy-on-write
+preload_app = True
+
+
+def post_fork(server, worker):
+    # Don't reuse database connections opened by the master before the fork
+    from app import app
+    from models import db
+    with app.app_context():
+        db.engine.dispose(close=False)
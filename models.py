@@ -1,22 +1,64 @@
 from flask_sqlalchemy import SQLAlchemy
+from flask_caching import Cache
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import aliased
 from flask_login import UserMixin
 from datetime import datetime
 from werkzeug.security import generate_password_hash, check_password_hash
 
 db = SQLAlchemy()
+cache = Cache()
+
+@event.listens_for(Engine, 'connect')
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    # WAL lets readers proceed while a writer holds the database
+    if type(dbapi_connection).__module__ != 'sqlite3':
+        return
+    cursor = dbapi_connection.cursor()
+    cursor.execute('PRAGMA journal_mode=WAL')
+    cursor.execute('PRAGMA synchronous=NORMAL')
+    cursor.execute('PRAGMA cache_size=-64000')
+    cursor.execute('PRAGMA mmap_size=268435456')
+    cursor.close()
+
+
+def run_off_hub(func, *args):
+    # Under gevent, CPU-bound work would block every greenlet in the worker;
+    # run it in the hub's native threadpool instead (hashlib releases the GIL)
+    try:
+        from gevent import get_hub, monkey
+    except ImportError:
+        return func(*args)
+    if not monkey.is_module_patched('socket'):
+        return func(*args)
+    return get_hub().threadpool.apply(func, args)
+
+
+# Badges are stored as a bitmask: (points threshold, bit)
+BADGE_THRESHOLDS = [(10, 1), (50, 2), (100, 4), (200, 8)]
+BADGE_NAMES = {1: 'Bronze Helper', 2: 'Silver Helper', 4: 'Gold Helper', 8: 'Platinum Helper'}
+
+
+def badge_names(badges):
+    return [name for bit, name in BADGE_NAMES.items() if badges & bit]
 
 class User(UserMixin, db.Model):
     __tablename__ = 'users'
+    __table_args__ = (
+        db.Index('ix_user_role_points', 'role', 'points'),  # leaderboard / impact rankings
+    )
     
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(100), nullable=False)
     email = db.Column(db.String(120), unique=True, nullable=False)
-    password_hash = db.Column(db.String(256), nullable=False)
+    password_hash = db.deferred(db.Column(db.String(256), nullable=False))  # only loaded on login
     role = db.Column(db.String(20), nullable=False)  # donor, volunteer, receiver
     location = db.Column(db.String(100), nullable=False)
     phone = db.Column(db.String(20))
     points = db.Column(db.Integer, default=0)
-    badges = db.Column(db.String(500), default='')  # comma-separated badges
+    badges = db.Column(db.Integer, default=0)  # bitmask of BADGE_NAMES
+    delivered_count = db.Column(db.Integer, default=0)  # running count of delivered tasks
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     
     # Relationships
@@ -25,35 +67,28 @@ class User(UserMixin, db.Model):
     tasks = db.relationship('Task', backref='volunteer', lazy=True)
     
     def set_password(self, password):
-        self.password_hash = generate_password_hash(password)
+        self.password_hash = run_off_hub(generate_password_hash, password)
     
     def check_password(self, password):
-        return check_password_hash(self.password_hash, password)
+        return run_off_hub(check_password_hash, self.password_hash, password)
     
     def add_points(self, points):
+        # Callers clear the cached leaderboard after committing
         self.points += points
         self.update_badges()
     
     def update_badges(self):
-        badges = []
-        if self.points >= 10:
-            badges.append('Bronze Helper')
-        if self.points >= 50:
-            badges.append('Silver Helper')
-        if self.points >= 100:
-            badges.append('Gold Helper')
-        if self.points >= 200:
-            badges.append('Platinum Helper')
-        self.badges = ','.join(badges)
+        self.badges = sum(bit for threshold, bit in BADGE_THRESHOLDS if self.points >= threshold)
     
     def get_badges_list(self):
-        if self.badges:
-            return self.badges.split(',')
-        return []
+        return badge_names(self.badges)
 
 
 class Donation(db.Model):
     __tablename__ = 'donations'
+    __table_args__ = (
+        db.Index('ix_don_status_loc_type', 'status', 'location', 'item_type'),
+    )
     
     id = db.Column(db.Integer, primary_key=True)
     donor_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
@@ -61,11 +96,11 @@ class Donation(db.Model):
     quantity = db.Column(db.Integer, nullable=False)
     condition = db.Column(db.String(20), default='good')  # new, good, fair
     description = db.Column(db.Text)
-    location = db.Column(db.String(100), nullable=False)
+    location = db.Column(db.String(100), nullable=False, index=True)
     pickup_address = db.Column(db.String(200))
     expiry_date = db.Column(db.Date)  # for food items
     status = db.Column(db.String(20), default='available')  # available, matched, completed
-    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
     
     # Relationships
     tasks = db.relationship('Task', backref='donation', lazy=True)
@@ -73,6 +108,9 @@ class Donation(db.Model):
 
 class Request(db.Model):
     __tablename__ = 'requests'
+    __table_args__ = (
+        db.Index('ix_req_status_loc_type', 'status', 'location', 'item_type'),
+    )
     
     id = db.Column(db.Integer, primary_key=True)
     receiver_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
@@ -91,16 +129,23 @@ class Request(db.Model):
 
 class Task(db.Model):
     __tablename__ = 'tasks'
+    __table_args__ = (
+        db.Index('ix_task_status_vol', 'status', 'volunteer_id'),
+        # Partial index over the open work queue only; stays small as delivered tasks pile up
+        db.Index('ix_task_open', 'donation_id',
+                 postgresql_where=db.text("volunteer_id IS NULL AND status = 'created'"),
+                 sqlite_where=db.text("volunteer_id IS NULL AND status = 'created'")),
+    )
     
     id = db.Column(db.Integer, primary_key=True)
     donation_id = db.Column(db.Integer, db.ForeignKey('donations.id'), nullable=False)
     request_id = db.Column(db.Integer, db.ForeignKey('requests.id'))
-    volunteer_id = db.Column(db.Integer, db.ForeignKey('users.id'))
+    volunteer_id = db.Column(db.Integer, db.ForeignKey('users.id'), index=True)
     status = db.Column(db.String(20), default='created')  # created, assigned, picked_up, delivered, verified
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     assigned_at = db.Column(db.DateTime)
     picked_up_at = db.Column(db.DateTime)
-    delivered_at = db.Column(db.DateTime)
+    delivered_at = db.Column(db.DateTime, index=True)
     verified_at = db.Column(db.DateTime)
     
     # Relationships
@@ -119,23 +164,196 @@ class ActivityLog(db.Model):
     actor = db.relationship('User', backref='activities')
 
 
+class PlatformStats(db.Model):
+    """Single-row table of running platform counters, updated in place"""
+    __tablename__ = 'platform_stats'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    total_donations = db.Column(db.Integer, nullable=False, default=0)
+    completed_deliveries = db.Column(db.Integer, nullable=False, default=0)
+    items_donated = db.Column(db.Integer, nullable=False, default=0)
+    total_users = db.Column(db.Integer, nullable=False, default=0)
+    total_volunteers = db.Column(db.Integer, nullable=False, default=0)
+
+
+def upgrade_schema():
+    """Bring a database created by an earlier version up to date; safe to run on every startup"""
+    user_columns = {c['name']: c for c in db.inspect(db.engine).get_columns('users')}
+    
+    # delivered_count is a running counter; older databases lack it, so add and backfill it from tasks
+    if 'delivered_count' not in user_columns:
+        with db.engine.begin() as conn:
+            conn.exec_driver_sql('ALTER TABLE users ADD COLUMN delivered_count INTEGER')
+        user_columns = {c['name']: c for c in db.inspect(db.engine).get_columns('users')}
+    delivered = db.select(db.func.count(Task.id)).where(
+        Task.volunteer_id == User.id, Task.status == 'delivered'
+    ).scalar_subquery()
+    db.session.execute(
+        db.update(User).where(User.delivered_count.is_(None)).values(delivered_count=delivered),
+        execution_options={'synchronize_session': False}
+    )
+    db.session.commit()
+    
+    # badges used to be a comma-separated VARCHAR; it is now an integer bitmask
+    if not isinstance(user_columns['badges']['type'], db.Integer):
+        users = User.__table__
+        with db.engine.begin() as conn:
+            if conn.dialect.name == 'sqlite':
+                # SQLite can't change a column's type: copy into a rebuilt table and swap it in
+                rebuilt = users.to_metadata(db.MetaData(), name='users_rebuilt')
+                columns = ', '.join(c.name for c in rebuilt.columns if c.name in user_columns and c.name != 'badges')
+                conn.execute(db.schema.CreateTable(rebuilt))
+                conn.exec_driver_sql(f'INSERT INTO users_rebuilt ({columns}, badges) SELECT {columns}, 0 FROM users')
+                conn.exec_driver_sql('DROP TABLE users')
+                conn.exec_driver_sql('ALTER TABLE users_rebuilt RENAME TO users')
+            else:
+                conn.exec_driver_sql('ALTER TABLE users ALTER COLUMN badges TYPE INTEGER USING 0')
+            # Badges only depend on points, so recompute the mask rather than parse the old names
+            conn.execute(db.update(users).values(badges=sum(
+                db.case((users.c.points >= threshold, bit), else_=0) for threshold, bit in BADGE_THRESHOLDS
+            )))
+    
+    # create_all() only creates missing tables, so indexes added to existing tables are created here
+    for table in db.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(db.engine, checkfirst=True)
+
+
+def init_platform_stats():
+    """Create the counters row, backfilled from existing data, if it is missing"""
+    if db.session.get(PlatformStats, 1):
+        return
+    # One round trip: every metric is a scalar subquery of a single SELECT
+    delivered = Task.status == 'delivered'
+    row = db.session.query(
+        db.select(db.func.count(Donation.id)).scalar_subquery(),
+        db.select(db.func.count(Task.id)).where(delivered).scalar_subquery(),
+        db.select(db.func.count(User.id)).scalar_subquery(),
+        db.select(db.func.count(db.case((User.role == 'volunteer', 1)))).scalar_subquery(),
+        db.select(db.func.sum(Donation.quantity))
+            .join(Task, Task.donation_id == Donation.id)
+            .where(delivered)
+            .scalar_subquery()
+    ).one()
+    total_donations, completed_tasks, total_users, total_volunteers, items_donated = row
+    
+    db.session.add(PlatformStats(
+        id=1,
+        total_donations=total_donations,
+        completed_deliveries=completed_tasks,
+        items_donated=items_donated or 0,
+        total_users=total_users,
+        total_volunteers=total_volunteers
+    ))
+    db.session.commit()
+
+
+def bump_platform_stats(**deltas):
+    """Increment counters in SQL, e.g. bump_platform_stats(total_donations=1)"""
+    db.session.query(PlatformStats).filter_by(id=1).update(
+        {getattr(PlatformStats, name): getattr(PlatformStats, name) + delta for name, delta in deltas.items()},
+        synchronize_session=False
+    )
+
+
+def bulk_insert_donations(rows):
+    """Create many donations (dicts of Donation columns) the way create_donation creates one:
+    each gets a task, an activity log and +10 points for its donor. Inserts use one executemany
+    per table; commits and clears the cached stats and recent donations.
+    Raises ValueError, before inserting anything, if a row names a donor that doesn't exist."""
+    if not rows:
+        return []
+    donors = {u.id: u for u in User.query.filter(User.id.in_({row['donor_id'] for row in rows}))}
+    missing = sorted({row['donor_id'] for row in rows} - donors.keys())
+    if missing:
+        raise ValueError(f'Unknown donor_id: {", ".join(map(str, missing))}')
+    
+    donation_ids = db.session.scalars(
+        db.insert(Donation).returning(Donation.id, sort_by_parameter_order=True), rows
+    ).all()
+    task_ids = db.session.scalars(
+        db.insert(Task).returning(Task.id, sort_by_parameter_order=True),
+        [{'donation_id': donation_id} for donation_id in donation_ids]
+    ).all()
+    
+    db.session.execute(db.insert(ActivityLog), [
+        {'task_id': task_id, 'action': f'Donation created by {donors[row["donor_id"]].name}', 'actor_id': row['donor_id']}
+        for task_id, row in zip(task_ids, rows)
+    ])
+    for row in rows:
+        donors[row['donor_id']].add_points(10)
+    bump_platform_stats(total_donations=len(donation_ids))
+    
+    db.session.commit()
+    cache.delete_memoized(get_platform_stats)
+    cache.delete_memoized(get_recent_donations)
+    cache.delete_memoized(get_leaderboard)
+    return donation_ids
+
+
 # Helper function to get stats
+@cache.memoize(timeout=60)
 def get_platform_stats():
-    total_donations = Donation.query.count()
-    completed_tasks = Task.query.filter_by(status='delivered').count()
-    total_users = User.query.count()
-    total_volunteers = User.query.filter_by(role='volunteer').count()
-    
-    # Calculate items donated
-    completed_donation_ids = [t.donation_id for t in Task.query.filter_by(status='delivered').all()]
-    items_donated = db.session.query(db.func.sum(Donation.quantity)).filter(
-        Donation.id.in_(completed_donation_ids)
-    ).scalar() or 0
+    stats = db.session.get(PlatformStats, 1)
     
     return {
-        'total_donations': total_donations,
-        'completed_deliveries': completed_tasks,
-        'total_users': total_users,
-        'total_volunteers': total_volunteers,
-        'items_donated': items_donated
+        'total_donations': stats.total_donations,
+        'completed_deliveries': stats.completed_deliveries,
+        'total_users': stats.total_users,
+        'total_volunteers': stats.total_volunteers,
+        'items_donated': stats.items_donated
     }
+
+
+@cache.memoize(timeout=30)
+def get_recent_donations(limit=5):
+    # Cached as plain dicts: ORM instances would come back from the cache detached
+    rows = db.session.execute(db.select(
+        Donation.id, Donation.item_type, Donation.quantity, Donation.location, Donation.status, Donation.created_at
+    ).order_by(Donation.created_at.desc()).limit(limit)).all()
+    return [row._asdict() for row in rows]
+
+
+@cache.memoize(timeout=120)
+def get_leaderboard(limit=20):
+    # Top users per role in one query instead of one query per role
+    # Cached as plain dicts: ORM instances would come back from the cache detached
+    rank = db.func.row_number().over(partition_by=User.role, order_by=User.points.desc()).label('rank')
+    ranked = db.select(
+        User.name, User.location, User.points, User.badges, User.role, rank
+    ).where(User.role.in_(['volunteer', 'donor'])).subquery()
+    rows = db.session.execute(db.select(ranked).where(ranked.c.rank <= limit).order_by(ranked.c.rank)).all()
+    users = [{'name': row.name, 'location': row.location, 'points': row.points,
+              'badges': badge_names(row.badges or 0), 'role': row.role} for row in rows]
+    return {
+        'volunteers': [u for u in users if u['role'] == 'volunteer'],
+        'donors': [u for u in users if u['role'] == 'donor']
+    }
+
+
+# Deliveries per page on /impact and /api/impact.json
+DELIVERIES_PAGE_SIZE = 20
+
+
+def get_completed_deliveries(limit, before=None, before_id=None):
+    """Newest deliveries as plain rows, keyset-paged on (delivered_at, id); no ORM objects are built"""
+    donor, volunteer, receiver = aliased(User), aliased(User), aliased(User)
+    query = db.select(
+        Task.id, Task.delivered_at,
+        Donation.item_type, Donation.quantity, Donation.location,
+        donor.name.label('donor_name'),
+        volunteer.name.label('volunteer_name'),
+        receiver.name.label('receiver_name')
+    ).join(Donation, Task.donation_id == Donation.id).join(
+        donor, Donation.donor_id == donor.id
+    ).outerjoin(volunteer, Task.volunteer_id == volunteer.id).outerjoin(
+        Request, Task.request_id == Request.id
+    ).outerjoin(receiver, Request.receiver_id == receiver.id).where(Task.status == 'delivered')
+    if before and before_id:
+        # The id breaks ties so deliveries sharing a timestamp aren't skipped at a page boundary
+        query = query.where(db.tuple_(Task.delivered_at, Task.id) < db.tuple_(before, before_id))
+    elif before:
+        query = query.where(Task.delivered_at < before)
+    return db.session.execute(
+        query.order_by(Task.delivered_at.desc(), Task.id.desc()).limit(limit)
+    ).all()
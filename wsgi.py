@@ -0,0 +1,7 @@
+# gevent must patch socket/threading/time before flask or sqlalchemy are imported
+from gevent import monkey
+monkey.patch_all()
+
+from app import app
+
+# Run with: gunicorn -c gunicorn_config.py wsgi:app